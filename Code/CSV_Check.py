@@ -1,6 +1,7 @@
 import csv
 import argparse as ap
 from pandas import read_csv, concat, DataFrame
+from CompressedIO import open_file
 
 
 def command_line():
@@ -10,7 +11,8 @@ def command_line():
                                               "provided in the previous Data Collection Step.",
                         nargs='+',
                         required=True)
-    parser.add_argument("-o", "--output", help="The output file's name", default="metadata.csv")
+    parser.add_argument("-o", "--output", help="The output file's name. Files ending with .gz or .zst are "
+                                               "compressed.", default="metadata.csv")
 
     return vars(parser.parse_args())
 
@@ -19,7 +21,8 @@ def export_metagenome_ids(files:list):
     all_metagenomes = []
     all_dfs = []
     for file in files:
-        df = read_csv(file)
+        with open_file(file, newline='') as f:  # .gz and .zst files are decompressed while reading
+            df = read_csv(f)
         #print(df)
         mgms = df['metagenome_id'].tolist()
         counter = 0
@@ -61,7 +64,8 @@ def main():
     files, output = args["input"], args["output"]
     print(files)
     final_df = export_metagenome_ids(files)
-    final_df.to_csv(output, index=False)
+    with open_file(output, 'w', newline='') as f:
+        final_df.to_csv(f, index=False)
     print(f"File saved to {output}")
 
     
@@ -0,0 +1,95 @@
+import gzip
+import io
+import shutil
+
+try:
+    import zstandard
+except ImportError:     # only needed for .zst files
+    zstandard = None
+
+
+COMPRESSION_EXTENSIONS = {"gzip": ".gz", "zstd": ".zst"}
+
+
+def compression_of(file:str):
+    '''
+    :param file: file name
+    :return: "gzip" or "zstd" if the extension of the file is .gz or .zst, None else
+    '''
+    for compression, extension in COMPRESSION_EXTENSIONS.items():
+        if file.endswith(extension):
+            return compression
+
+    return None
+
+
+def split_compression(name:str, compression:str=None):
+    '''
+    :param name: file name, e.g. metadata or metadata.gz
+    :param compression: compression selected by the user. Overrides the extension of name.
+    :return: name without compression extension, compression (None if uncompressed)
+    '''
+    detected = compression_of(name)
+    if detected is not None:
+        name = name[:-len(COMPRESSION_EXTENSIONS[detected])]
+
+    return name, compression or detected
+
+
+def with_compression(name:str, compression:str=None):
+    '''
+    :return: name with the extension of the compression, e.g. request_0.json => request_0.json.gz
+    '''
+    if compression is None or compression_of(name) is not None:
+        return name
+
+    return name + COMPRESSION_EXTENSIONS[compression]
+
+
+def open_file(file:str, mode:str='r', newline:str=None):
+    '''
+    Opens a plain, gzip (.gz) or zstd (.zst) file. Compressed files are (de)compressed while streaming, so they are
+    never held in memory completely. Files opened for appending get a new gzip member / zstd frame.
+    :param file: file name. The compression is detected by its extension.
+    :param mode: 'r', 'w' or 'a', optionally combined with 'b' or 't'
+    :param newline: see open()
+    :return: file object
+    '''
+    compression = compression_of(file)
+    binary = 'b' in mode
+    base_mode = mode.replace('b', '').replace('t', '')
+
+    if compression is None:
+        return open(file, mode, newline=None if binary else newline)
+
+    if compression == "gzip":
+        # level 6 instead of 9: nearly the same size, but a lot faster
+        fh = gzip.open(file, base_mode + 'b', compresslevel=6)
+    else:
+        if zstandard is None:
+            raise ImportError(f"The zstandard module is needed to read and write {file}. "
+                              f"Install it with: pip install zstandard")
+        raw = open(file, base_mode + 'b')
+        if base_mode == 'r':
+            # appended files consist of several frames
+            fh = zstandard.ZstdDecompressor().stream_reader(raw, read_across_frames=True, closefd=True)
+        else:
+            fh = zstandard.ZstdCompressor().stream_writer(raw, closefd=True)
+
+    if binary:
+        return fh
+
+    return io.TextIOWrapper(fh, encoding='utf-8', newline=newline)
+
+
+def copy_file(source:str, destination:str):
+    '''
+    Copies source to destination. If both files use a different compression, the content is converted while
+    streaming.
+    '''
+    if compression_of(source) == compression_of(destination):
+        shutil.copyfile(source, destination)
+        return
+
+    with open_file(source, 'rb') as src, open_file(destination, 'wb') as dst:
+        shutil.copyfileobj(src, dst)
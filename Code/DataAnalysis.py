@@ -4,6 +4,7 @@ from pandas import read_csv
 import matplotlib.pyplot as plt
 import numpy as np
 import ast
+from CompressedIO import open_file
 
 class bcolors:
     HEADER = '\033[95m'
@@ -19,7 +20,8 @@ class bcolors:
 def command_line():
     parser = ap.ArgumentParser("Metagenomic Data Collection (via MG-Rast) - Metadata Analysis")
 
-    parser.add_argument("-i", "--input", help="Metadata csv file that shall be analyzed.",
+    parser.add_argument("-i", "--input", help="Metadata csv file that shall be analyzed. Can be compressed (.gz or"
+                                              " .zst).",
                         required=True)
     #parser.add_argument("-o", "--output", help="Output File name", default="metadata_analyzer.png")
     #parser.add_argument("-f", "--format", help="Choose the output's format. Default: pdf", default="png")
@@ -281,7 +283,9 @@ def main():
     print("Analyzing data ... ")
 
     args = command_line()
-    df, keyword_pie, keyword_bar = read_csv(args["input"]), args["keyword_pie"], args["keyword_bar"]
+    with open_file(args["input"], newline='') as f:
+        df = read_csv(f)
+    keyword_pie, keyword_bar = args["keyword_pie"], args["keyword_bar"]
     alpha_div = args["alpha_diversity"]
     rc = args["rarefaction_curve"]
     seq_count = args["sequence_count_raw"]
@@ -6,8 +6,25 @@ from pathlib import Path
 import argparse as ap
 import time
 import ast
+import logging
+import re
+import threading
+import math
+import hashlib
+import heapq
+import shlex
+import sys
+import shutil
+import zlib
+from urllib.parse import urlsplit, urlunsplit, parse_qsl
 import numpy as np
 import requests
+from CompressedIO import open_file, copy_file, compression_of, split_compression, with_compression
+
+
+METADATA_COLUMNS = ['metagenome_id','project_name','project_id','biome','country','material','feature',
+                    'sequence_type','seq_meth','sequence_count_raw','alpha_diversity_shannon',
+                    'env_package_name','species_count','RC_slope','keyword']
 
 
 class bcolors:
@@ -22,6 +39,89 @@ class bcolors:
     UNDERLINE = '\033[4m'
 
 
+logger = logging.getLogger("metadata_collection")
+
+
+class JsonFormatter(logging.Formatter):
+    '''
+    One json object per line: time, level, message and the structured fields passed with extra={"fields": {...}}.
+    '''
+    def format(self, record):
+        message = re.sub(r'\033\[[0-9;]*m', '', record.getMessage())  # no terminal colors in json
+        entry = {"time": round(record.created, 3), "level": record.levelname, "message": message}
+        entry.update(getattr(record, "fields", {}))
+        return js.dumps(entry, default=str)
+
+
+def setup_logging(level:str="INFO", quiet:bool=False, json_lines:bool=False):
+    '''
+    :param level: DEBUG, INFO, WARNING or ERROR
+    :param quiet: only log warnings and errors
+    :param json_lines: log structured json lines instead of plain text
+    '''
+    handler = logging.StreamHandler()
+    handler.setFormatter(JsonFormatter() if json_lines else logging.Formatter("%(message)s"))
+    logger.handlers = [handler]
+    logger.setLevel(logging.WARNING if quiet else level)
+    logger.propagate = False
+
+
+class Progress:
+    '''
+    Counts the evaluated and accepted datasets of the current request. A background thread logs a progress line
+    every interval seconds, so the harvest loop itself never writes to the terminal.
+    '''
+    def __init__(self, interval:float):
+        self.interval = interval
+        self.request = None
+        self.limit = None
+        self.evaluated = 0
+        self.accepted = 0
+        self.started = time.time()
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+
+    def start(self):
+        if self.interval > 0:
+            self._thread.start()
+        return self
+
+    def begin(self, request:int, limit:int):
+        if self.request is not None:
+            self.report()
+        self.request, self.limit = request, limit
+        self.evaluated, self.accepted = 0, 0
+        self.started = time.time()
+
+    def update(self, accepted:bool):
+        self.evaluated += 1
+        self.accepted += bool(accepted)
+
+    def report(self):
+        elapsed = max(time.time() - self.started, 1e-9)
+        rate = self.evaluated / elapsed
+        eta = None
+        if self.accepted > 0 and self.limit:
+            eta = (self.limit - self.accepted) / (self.accepted / elapsed)
+        fields = {"request": self.request, "evaluated": self.evaluated, "accepted": self.accepted,
+                  "limit": self.limit, "requests_per_s": round(rate, 2), "eta_s": None if eta is None else round(eta)}
+        eta_text = "unknown" if eta is None else f"{eta:.0f}s" if eta < 60 else f"{eta / 60:.1f}min"
+        logger.info(f"request {self.request}: {self.evaluated} evaluated, {self.accepted}/{self.limit} accepted, "
+                    f"{rate:.2f} req/s, ETA {eta_text}", extra={"fields": fields})
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            if self.request is not None:
+                self.report()
+
+    def stop(self):
+        self._stop.set()
+        if self._thread.is_alive():
+            self._thread.join()
+        if self.request is not None:
+            self.report()
+
+
 def command_line():
     parser = ap.ArgumentParser("Metagenomic Data Collection (via MG-Rast)")
 
@@ -32,6 +132,15 @@ def command_line():
             raise argparse.ArgumentTypeError("%s is an invalid positive int value" % value)
         return ivalue
 
+    def check_shard(value):
+        try:
+            index, count = (int(i) for i in value.split('/'))
+        except ValueError:
+            raise ap.ArgumentTypeError("%s is not of the form INDEX/COUNT" % value)
+        if count < 1 or not 0 <= index < count:
+            raise ap.ArgumentTypeError("%s is an invalid shard (0 <= INDEX < COUNT)" % value)
+        return index, count
+
     parser.add_argument("-o", "--output", help="Name of the Output csv file. Default: metadata", default="metadata")
     parser.add_argument("-l", "--limit", help="Maximum number of API Search results from MG-Rast. "
                                               " Multiple input values possible. See Readme for Example. Default: 40",
@@ -73,6 +182,51 @@ def command_line():
     parser.add_argument("--no_duplicate_proj", help="If this option is selected, the resulting metadata file will "
                                                     "only contain each project, once.",
                         action='store_true')
+    parser.add_argument("--shard", help="Run one worker of a sharded harvest, e.g. \"--shard 0/4\" for the first of 4 "
+                                        "workers. The datasets are partitioned by project. The worker saves its results"
+                                        " to <output>.shard<INDEX>of<COUNT>.csv. See Readme.",
+                        default=None, type=check_shard)
+    parser.add_argument("--merge_shards", help="Merge the results of COUNT shard workers into the output file. Use the "
+                                               "same options as for the workers. No requests are sent to MG-Rast.",
+                        default=None, type=check_positive)
+    parser.add_argument("--incremental", help="Incremental harvest. Saves the newest created_on date of each request "
+                                              "to the given state file and only evaluates newer datasets in the next "
+                                              "run. The results are appended to the output file. Requires "
+                                              "--order_field created_on. See Readme.", default=None)
+    parser.add_argument("--plan", help="Dry run: only request the first page of each API Search, check a few "
+                                       "rarefaction curves and predict the number of requests, the data volume and "
+                                       "the time of the harvest. See Readme.",
+                        action='store_true')
+    parser.add_argument("--plan_samples", help="Number of rarefaction curves checked per request in --plan mode. "
+                                               "Default: 5", default=5, type=check_positive)
+    parser.add_argument("--plan_workers", help="Number of shard workers the --plan prediction is made for. "
+                                               "Default: COUNT of --shard, else 1", default=None, type=check_positive)
+    parser.add_argument("--rc_store", help="Directory of a rarefaction curve store. If set, every fetched rarefaction "
+                                           "curve is appended to it and can be re-screened offline with "
+                                           "RescreenRarefaction.py.", default=None)
+    parser.add_argument("--compress", help="Compress the search pages, the cache and the output file(s) with gzip "
+                                           "(.gz) or zstd (.zst). Files are also compressed if the output name ends "
+                                           "with .gz or .zst. zstd requires the zstandard module.",
+                        default=None, choices=["gzip", "zstd"])
+    parser.add_argument("--log_level", help="Level of the log messages. Default: INFO", default="INFO",
+                        choices=["DEBUG", "INFO", "WARNING", "ERROR"])
+    parser.add_argument("-q", "--quiet", help="Only log warnings and errors.", action='store_true')
+    parser.add_argument("--log_json", help="Log one json object per line instead of plain text.", action='store_true')
+    parser.add_argument("--progress_interval", help="Seconds between two progress lines (evaluated and accepted "
+                                                    "datasets, requests per second, ETA). 0 disables them. Default: 10",
+                        default=10, type=float)
+    parser.add_argument("--cache_dir", help="Directory in which the pages of the API Search are cached. "
+                                            "Default: .search_cache", default=".search_cache")
+    parser.add_argument("--cache_ttl", help="Number of seconds a cached search page is considered fresh. Stale "
+                                            "pages are revalidated with MG-Rast. Default: 86400 (1 day)",
+                        default=86400, type=check_positive)
+    parser.add_argument("--cache_max_entries", help="Maximum number of search pages kept in the cache. Once the "
+                                                    "cache grew a tenth past it, the least recently used pages are "
+                                                    "removed. Default: 10000",
+                        default=10000, type=check_positive)
+    parser.add_argument("--no_cache", help="If this option is selected, every search page is requested from MG-Rast "
+                                           "and nothing is cached.",
+                        action='store_true')
 
     return vars(parser.parse_args())
 
@@ -147,18 +301,202 @@ def generate_all_curls(metadata_fields:dict, limits:list, desc:bool, spd:bool, o
 
     return all_curls
 
-def run_curls(all_curls:dict, json:list):
+def search_request_key(curl:str):
+    '''
+    Canonical form of an API Search request that does not depend on the order of its parameters.
+    Works for the generated curl requests (-F "field=value") as well as for the "next" links returned by MG-Rast.
+    :param curl: curl command of an API Search request
+    :return: list [url, sorted list of [parameter, value]]
+    '''
+    tokens = shlex.split(curl)
+    params = []
+    url = ""
+    i = 1
+    while i < len(tokens):
+        if tokens[i] == "-F":
+            name, _, value = tokens[i+1].partition("=")
+            params.append([name, value])
+            i += 2
+        else:
+            if not tokens[i].startswith("-"):
+                url = tokens[i]
+            i += 1
+
+    split = urlsplit(url)
+    params += [[name, value] for name, value in parse_qsl(split.query, keep_blank_values=True)]
+    url = urlunsplit((split.scheme, split.netloc, split.path, '', ''))
+
+    return [url, sorted(params)]
+
+
+def search_fingerprint(curl:str):
+    '''
+    :param curl: curl command of an API Search request
+    :return: sha256 hex digest of the canonical request. Identical queries and page cursors give identical fingerprints.
+    '''
+    canonical = js.dumps(search_request_key(curl), separators=(',', ':'))
+    return hashlib.sha256(canonical.encode()).hexdigest()
+
+
+def read_response_headers(headers_file:str):
+    '''
+    :param headers_file: file written by curl -D
+    :return: HTTP status code (None if unknown) and a dict with the lower-cased headers of the final response
+    '''
+    if not os.path.exists(headers_file):
+        return None, {}
+
+    with open(headers_file, errors='replace') as f:
+        blocks = [b for b in f.read().replace('\r\n', '\n').split('\n\n') if b.startswith("HTTP/")]
+
+    if not blocks:
+        return None, {}
+
+    lines = blocks[-1].split('\n')
+    try:
+        status = int(lines[0].split()[1])
+    except (IndexError, ValueError):
+        status = None
+
+    headers = {}
+    for line in lines[1:]:
+        name, sep, value = line.partition(':')
+        if sep:
+            headers[name.strip().lower()] = value.strip()
+
+    return status, headers
+
+
+def evict_search_cache(cache:dict):
+    '''
+    Counts a new page of the cache. Once the cache grew a tenth past cache["max_entries"] pages, the least recently
+    used pages are removed until it holds at most cache["max_entries"] pages again. Only then is the cache directory
+    listed, so adding a page stays cheap even for large caches.
+    :param cache: dict with the cache settings (dir, ttl, max_entries, compression) and the number of cached pages
+    (entries)
+    '''
+    cache["entries"] += 1
+    if cache["entries"] <= cache["max_entries"] + max(cache["max_entries"] // 10, 1):
+        return
+
+    entries = [os.path.join(cache["dir"], f[:-len(".info")]) for f in os.listdir(cache["dir"]) if f.endswith(".info")]
+    cache["entries"] = min(len(entries), cache["max_entries"])
+    if len(entries) <= cache["max_entries"]:
+        return
+
+    entries.sort(key=lambda entry: os.path.getmtime(f"{entry}.info") if os.path.exists(f"{entry}.info") else 0)
+    for entry in entries[:len(entries)-cache["max_entries"]]:
+        for f in [f"{entry}.info"] + [f"{entry}.json{ext}" for ext in ("", ".gz", ".zst")]:
+            try:
+                os.remove(f)
+            except FileNotFoundError:   # already evicted by a concurrent run
+                pass
+
+
+def run_curl(curl:str, destination:str, options:list=None):
+    '''
+    Runs a curl command and saves the response to destination. If destination ends with .gz or .zst, the response is
+    compressed while it is downloaded.
+    :param curl: curl command (without -o)
+    :param destination: file the response is saved to
+    :param options: additional curl options
+    '''
+    args = shlex.split(curl) + (options or [])
+    if compression_of(destination) is None:
+        subprocess.run(args + ["-o", destination])
+        return
+
+    with subprocess.Popen(args, stdout=subprocess.PIPE) as process, open_file(destination, 'wb') as f:
+        shutil.copyfileobj(process.stdout, f)
+
+
+def fetch_search_page(curl:str, destination:str, cache:dict):
+    '''
+    Runs an API Search request and saves the resulting page to destination.
+    If caching is enabled, pages are stored under the fingerprint of the request. Fresh pages (younger than
+    cache["ttl"] seconds) are served locally, stale pages are revalidated with the ETag / Last-Modified headers of the
+    previous response. If MG-Rast does not answer with 304 Not Modified, the page is downloaded again.
+    :param curl: curl command of an API Search request (without -o)
+    :param destination: json file the page is saved to (.gz or .zst for compressed pages)
+    :param cache: dict with the cache settings (dir, ttl, max_entries, compression). None disables the cache.
+    :return: True, if the page was served from the cache
+    '''
+    if cache is None:
+        run_curl(curl, destination)
+        return False
+
+    entry = os.path.join(cache["dir"], search_fingerprint(curl))
+    page = with_compression(f"{entry}.json", cache.get("compression"))
+    info_file = f"{entry}.info"
+
+    info = {}
+    if os.path.exists(page) and os.path.exists(info_file):
+        try:
+            with open(info_file) as f:
+                info = js.load(f)
+        except ValueError:
+            info = {}
+
+    if info and time.time() - info["fetched"] < cache["ttl"]:
+        copy_file(page, destination)
+        os.utime(info_file)  # mark as recently used
+        return True
+
+    conditional = []
+    if info.get("etag"):
+        conditional += ["-H", f"If-None-Match: {info['etag']}"]
+    if info.get("last_modified"):
+        conditional += ["-H", f"If-Modified-Since: {info['last_modified']}"]
+
+    # unique names, so that overlapping runs can share the cache
+    part = with_compression(f"{entry}.{os.getpid()}.part.json", cache.get("compression"))
+    headers_file = f"{entry}.{os.getpid()}.headers"
+    try:
+        run_curl(curl, part, conditional + ["-D", headers_file])
+        status, headers = read_response_headers(headers_file)
+
+        if status == 304 and info:
+            info["fetched"] = time.time()
+            copy_file(page, destination)
+        elif status == 200 and os.path.exists(part):
+            info = {"fetched": time.time(), "etag": headers.get("etag"), "last_modified": headers.get("last-modified")}
+            copy_file(part, destination)
+            os.replace(part, page)
+        else:   # do not cache failed requests
+            if os.path.exists(part):
+                copy_file(part, destination)
+            return False
+    finally:
+        # compressed downloads always create the part file, even if the response is empty (304)
+        for f in (part, headers_file):
+            if os.path.exists(f):
+                os.remove(f)
+
+    new_entry = not os.path.exists(info_file)
+    with open(f"{info_file}.{os.getpid()}", 'w') as f:
+        js.dump(info, f)
+    os.replace(f"{info_file}.{os.getpid()}", info_file)
+    if new_entry:
+        evict_search_cache(cache)
+
+    return status == 304
+
+
+def run_curls(all_curls:dict, json:list, cache:dict=None):
     '''
     Example: curl  -F "limit=5" -F "order=created_on" -F "direction=asc" -F "public=yes" -F "all=soil" "https://api.mg-rast.org/search"
     :param all_curls: dict containing all curls
+    :param cache: dict with the search cache settings. None disables the cache.
     :return: creates json files based on the requests and names it: request_<n>.json
     '''
     file_list = []
     counter = 1
     for key in all_curls.keys():
-        print(all_curls[key]+f" -o {json[key-1]}.json")
-        os.system(f"{all_curls[key]} -o {json[key-1]}")
-        print(f"{bcolors.OKGREEN}File saved to {json[key-1]}{bcolors.ENDC}")
+        logger.debug(all_curls[key]+f" -o {json[key-1]}")
+        if fetch_search_page(all_curls[key], json[key-1], cache):
+            logger.debug(f"{bcolors.OKCYAN}Served from cache{bcolors.ENDC}")
+        logger.info(f"{bcolors.OKGREEN}File saved to {json[key-1]}{bcolors.ENDC}",
+                    extra={"fields": {"request": key, "file": json[key-1]}})
         file_list.append(f"{json[key-1]}")
         counter+=1
 
@@ -176,165 +514,676 @@ def check_next(temp:dict):
         next_curl = "No more next"
         return next_curl, n
 
-# import a given json file into the program
-def import_json(file):
+def dataset_row(p:dict):
+    '''
+    :param p: dataset of an API Search page
+    :return: list with the twelve metadata columns used for the metadata file, None if the dataset is a 16S dataset
+    or misses one of the columns
+    '''
+    for i in p:
+        if '16S' in str(p[i]) or '16s' in str(p[i]):
+            return None
 
+    try:
+        results = [p['metagenome_id'],p['project_name'],p['project_id'],p['biome'],p['country'],p['material'],p['feature'],
+                    p['sequence_type'],p['seq_meth'],p['sequence_count_raw'],p['alpha_diversity_shannon']]
+    except KeyError:
+        return None
+    results.append(p.get('env_package_name', 'None'))
 
-    if not file.startswith('.'):    # need this to ignore hidden files in MacOS
+    return results
 
-        all_results = {}
-        with open(file) as json_file:
 
-            temp = js.loads(json_file.read())
+JSON_WHITESPACE = re.compile(r'[ \t\n\r]*')
 
-            next_curl, n = check_next(temp)
 
-            for p in temp['data']:
+def stream_search_page(file:str, page:dict=None, created:dict=None, chunk_size:int=65536, stats:dict=None):
+    '''
+    Incremental parser for a page of the API Search. The datasets of the "data" array are decoded and filtered one at
+    a time, so only the current dataset (and one chunk of the file) is held in memory, independent of the page size.
+    :param file: json file containing one page of the API Search
+    :param page: if given, all other top level values of the page (e.g. next, total_count) are stored in it. They are
+    complete once the generator is exhausted.
+    :param created: if given, the created_on date of each dataset is stored in it (key: metagenome id)
+    :param chunk_size: number of characters read at once
+    :param stats: if given, the number of datasets in the "data" array (before filtering) and the number of characters
+    of the page are stored in it ("datasets", "characters")
+    :return: generator of the rows of all datasets that pass dataset_row
+    '''
+    if stats is None:
+        stats = {}
+    stats["datasets"] = 0
+    stats["characters"] = 0
+    decoder = js.JSONDecoder()
+    buffer = ""
+    pos = 0
+    eof = False
+
+    with open_file(file) as json_file:
+
+        def fill():
+            nonlocal buffer, pos, eof
+            chunk = json_file.read(chunk_size)
+            stats["characters"] += len(chunk)
+            eof = not chunk
+            buffer = buffer[pos:] + chunk
+            pos = 0
+
+        def skip_whitespace():
+            nonlocal pos
+            while True:
+                pos = JSON_WHITESPACE.match(buffer, pos).end()
+                if pos < len(buffer) or eof:
+                    return
+                fill()
+
+        def expect(characters:str):
+            nonlocal pos
+            skip_whitespace()
+            if pos >= len(buffer) or buffer[pos] not in characters:
+                raise ValueError(f"{file} is not a valid search page, expected one of {characters!r}")
+            pos += 1
+            return buffer[pos-1]
+
+        def decode_value():
+            nonlocal pos
+            skip_whitespace()
+            while True:
+                try:
+                    value, end = decoder.raw_decode(buffer, pos)
+                    # a number at the end of the buffer might continue in the next chunk
+                    if end < len(buffer) or eof:
+                        pos = end
+                        return value
+                except ValueError:
+                    if eof:
+                        raise
+                fill()
+
+        expect('{')
+        skip_whitespace()
+        if buffer[pos:pos+1] == '}':
+            return
+
+        while True:
+            key = decode_value()
+            expect(':')
+            if key == 'data':
+                expect('[')
+                skip_whitespace()
+                if buffer[pos:pos+1] == ']':
+                    pos += 1
+                else:
+                    while True:
+                        p = decode_value()
+                        stats["datasets"] += 1
+                        results = dataset_row(p) if isinstance(p, dict) else None
+                        if results is not None:
+                            if created is not None:
+                                created_on = p.get('created_on')
+                                created[p['metagenome_id']] = '' if created_on is None else str(created_on)
+                            yield results
+                        if expect(',]') == ']':
+                            break
+            else:
+                value = decode_value()
+                if page is not None:
+                    page[key] = value
 
-                b = False
+            if expect(',}') == '}':
+                return
 
-                for i in p:
-                    if '16S' in str(p[i]) or '16s' in str(p[i]):
-                        b = True
 
-                if b:
-                    continue
+def iterate_candidates(file:str, cache:dict=None, created:dict=None):
+    '''
+    Yields the datasets of an API Search one at a time, while the pages are parsed (see stream_search_page). The next
+    page is only requested, once all datasets of the current page were consumed.
+    :param file: json file containing the first page of the API Search
+    :param cache: dict with the search cache settings. None disables the cache.
+    :param created: if given, holds the created_on dates of the datasets of the current page (see stream_search_page)
+    :return: generator of the dataset rows (see dataset_row)
+    '''
+    while True:
+        page = {}
+        for results in stream_search_page(file, page, created):
+            yield results
+
+        # if there exists a next, then do the following
+        next_curl, n = check_next(page)
+        if not n:
+            break
+        fetch_search_page(f"curl \"{next_curl}\"", file, cache)
+        if created is not None:
+            created.clear()
+
+
+def fetch_rarefaction_text(mgm:str):
+    '''
+    :param mgm: metagenome id
+    :return: rarefaction curve of the metagenome as returned by MG-Rast (String in list format)
+    '''
+    curl = f"https://api-ui.mg-rast.org/metagenome/{mgm}?verbosity=stats&detail=rarefaction"
+
+    return os.popen(f"curl \"{curl}\"").read()
+
+
+def fetch_rarefaction(mgm:str):
+    '''
+    :param mgm: metagenome id
+    :return: rarefaction curve of the metagenome ([[x1, y1], [x2, y2], ...])
+    '''
+    return ast.literal_eval(fetch_rarefaction_text(mgm))  # turn nested string list into actual list
 
-                try:
-                    results = [p['metagenome_id'],p['project_name'],p['project_id'],p['biome'],p['country'],p['material'],p['feature'],
-                                p['sequence_type'],p['seq_meth'],p['sequence_count_raw'],p['alpha_diversity_shannon']]
-                except:
-                    continue
-                try:
-                    results.append(p['env_package_name'])
-                except:
-                    results.append('None')
 
-                all_results[p['metagenome_id']] = results
+def evaluate_candidate(row:list, keyword:list, threshold:float, min_species:int, min_reads:int, ignore_slope:bool,
+                       rc_store:dict=None):
+    '''
+    Fetches the rarefaction curve of a dataset and checks it (see check_rarefaction).
+    :param row: dataset row (see dataset_row)
+    :param keyword: metadata of the API Search the dataset was found with
+    :param rc_store: rarefaction curve store the curve is appended to. Optional.
+    :return: accepted (bool), slope of the rarefaction curve, species count
+    '''
+    rarefactions = fetch_rarefaction(row[0])
+    if rc_store is not None:
+        append_rc_curve(rc_store, row, keyword, rarefactions)
 
-        return all_results, n, next_curl
+    return check_rarefaction(rarefactions, threshold, min_species, min_reads, ignore_slope)
 
 
-def create_metadata(file_list:list, output:str, threshold:float, limits:list, min_species:int, metadata:dict, p:bool, ignore_slope:bool, min_reads:int, no_dup_proj:bool):
+def claim_candidate(mgm:str, project_n:str, metagenome_ids:set, project_ids:set, no_dup_proj:bool):
+    '''
+    Duplicate rules of a harvest: each metagenome is only evaluated once and, if no_dup_proj is set, only the first
+    evaluated metagenome of each project.
+    :return: True, if the dataset has to be evaluated. metagenome_ids and project_ids are updated in that case.
+    '''
+    mgm, project_n = str(mgm), str(project_n)  # ids read back from csv files are strings
+    if mgm in metagenome_ids:   # ensure that each metagenome only appears once
+        return False
+    if no_dup_proj:
+        if project_n in project_ids:
+            return False
+        project_ids.add(project_n)
+    metagenome_ids.add(mgm)
+
+    return True
+
+
+def is_16s(row:list):
+
+    return any("16S" in str(i) or "16s" in str(i) for i in row)
+
+
+def create_metadata(file_list:list, output:str, threshold:float, limits:list, min_species:int, metadata:dict, p:bool, ignore_slope:bool, min_reads:int, no_dup_proj:bool, cache:dict=None, rc_store:dict=None, watermarks:list=None, compression:str=None, progress:Progress=None):
     '''
     Import all the previously created json files
     :param file_list: list of json files that were created previously
+    :param cache: dict with the search cache settings. None disables the cache.
+    :param rc_store: rarefaction curve store (see open_rc_store) that every fetched curve is appended to. Optional.
+    :param watermarks: incremental mode. One high-water mark per request (see advance_watermark), the search results
+    need to be ordered by created_on in descending order. Only datasets newer than the mark are evaluated, the
+    accepted ones are appended to the output file and the marks are updated in place.
+    :param compression: "gzip" or "zstd" to compress the output file. Optional.
+    :param progress: Progress that counts the evaluated datasets. Optional.
     :return: a file with metagenome information and a list with all unique metagenomic ids
     '''
 
-    with open(f'{output}.csv', 'w', newline='') as csvfile:
+    output_file = with_compression(f'{output}.csv', compression)
+    append = watermarks is not None and os.path.exists(output_file)
+    with open_file(output_file, 'a' if append else 'w', newline='') as csvfile:
         csvfile_writer = csv.writer(csvfile, delimiter=',')
-        csvfile_writer.writerow(['metagenome_id','project_name','project_id','biome','country','material','feature',
-                                 'sequence_type','seq_meth','sequence_count_raw','alpha_diversity_shannon',
-                                 'env_package_name','species_count','RC_slope','keyword'])
+        if not append:
+            csvfile_writer.writerow(METADATA_COLUMNS)
         counter = 1
-        metagenome_ids = []
+        metagenome_ids = set()
         good_ids = []
-        project_ids = []
+        project_ids = set()
+        if append:
+            # the duplicate rules also hold for the datasets of previous runs (and of an interrupted run)
+            metagenome_ids, project_ids = read_harvested_ids(output_file)
         for k, file in enumerate(file_list):
 
-            print(file)
+            if progress is not None:
+                progress.begin(counter, limits[k])
+            logger.info(f"Processing {file}", extra={"fields": {"request": counter, "file": file}})
             temp_ids = []
-            d, n, next_curl = import_json(file)
-            while d is not None:
-                for key in d.keys():
-                    b = False
-                    for i in d[key]:
-                        if not p and ("16S" in str(i) or "16s" in str(i)):
-                            b = True
-                            break
-                        else:
-                            mgm = d[key][0]
-                            #print(mgm)
-                            project_n = d[key][2]
-                            # change this to mgm not in metagenome ids if projects can be the same
-                            if mgm not in metagenome_ids:   # ensure that each metagenome only appears once
-                                if no_dup_proj:
-                                    if project_n not in project_ids:
-                                        project_ids.append(project_n)
-
-                                        metagenome_ids.append(mgm)
-                                        curl = f"https://api-ui.mg-rast.org/metagenome/{mgm}" \
-                                               f"?verbosity=stats&detail=rarefaction"
-                                        rarefactions = os.popen(
-                                            f"curl \"{curl}\"").read()  # creates String in list format
-                                        rarefactions = ast.literal_eval(
-                                            rarefactions)  # turn nested string list into actual list
-                                        # print(type(rarefactions))
-                                        # rarefactions = os.system(f'curl \"{curl}\"')
-
-                                        try:
-                                            r_co, grad, species_count = check_rarefaction(rarefactions, threshold, min_species, min_reads, ignore_slope)
-                                        except:
-                                            break
-                                        # rarefaction curve coefficient
-
-                                        if r_co:
-                                            print(r_co)
-                                            temp_ids.append(mgm)
-                                            good_ids.append(mgm)
-                                            d_key = d[key]
-                                            d_key.append(species_count)
-                                            d_key.append(grad)
-                                            print(metadata)
-                                            d_key.append(metadata[counter])
-
-                                            csvfile_writer.writerow(d_key)
-
-                                            if len(temp_ids) == limits[k]:
-                                                break
-
-                                else:
-                                    metagenome_ids.append(mgm)
-                                    curl = f"https://api-ui.mg-rast.org/metagenome/{mgm}" \
-                                           f"?verbosity=stats&detail=rarefaction"
-                                    rarefactions = os.popen(f"curl \"{curl}\"").read() # creates String in list format
-                                    rarefactions = ast.literal_eval(rarefactions) # turn nested string list into actual list
-                                    #print(type(rarefactions))
-                                    #rarefactions = os.system(f'curl \"{curl}\"')
-
-                                    r_co, grad, species_count = \
-                                        check_rarefaction(rarefactions, threshold, min_species, min_reads, ignore_slope)
-                                # rarefaction curve coefficient
-
-                                    if r_co:
-
-                                        #curl2 = f"curl \"https://api-ui.mg-rast.org/download/{mgm}?file=299.1\" > "
-
-
-                                        print(r_co)
-                                        temp_ids.append(mgm)
-                                        good_ids.append(mgm)
-                                        d_key = d[key]
-                                        d_key.append(species_count)
-                                        d_key.append(grad)
-                                        print(metadata)
-                                        d_key.append(metadata[counter])
-
-                                        csvfile_writer.writerow(d_key)
-
-                                        if len(temp_ids) == limits[k]:
-                                            break
+            created = None if watermarks is None else {}
+            walked = []
+            reached_mark = True
+            undated = 0
+            seen = set() if watermarks is None else set(watermarks[k]["ids"])
+            for row in iterate_candidates(file, cache, created):
+                if watermarks is not None:
+                    created_on = created.get(row[0], '')
+                    if not created_on:  # cannot be placed relative to the mark
+                        undated += 1
+                        continue
+                    if watermarks[k]["created_on"] is not None and created_on < watermarks[k]["created_on"]:
+                        break   # all remaining datasets were already harvested
+                    walked.append((row[0], created_on))
+                    if row[0] in seen:
+                        continue
+
+                if not p and is_16s(row):
+                    continue
+                mgm, project_n = row[0], row[2]
+                if not claim_candidate(mgm, project_n, metagenome_ids, project_ids, no_dup_proj):
+                    continue
+
+                r_co, grad, species_count = evaluate_candidate(row, metadata[counter], threshold, min_species,
+                                                               min_reads, ignore_slope, rc_store)
+                if progress is not None:
+                    progress.update(r_co)
+                # rarefaction curve coefficient
+                if r_co:
+                    temp_ids.append(mgm)
+                    good_ids.append(mgm)
+                    csvfile_writer.writerow(row + [species_count, grad, metadata[counter]])
 
                     if len(temp_ids) == limits[k]:
-                        return
+                        reached_mark = False
+                        break
+
+            if undated:
+                logger.warning(f"{undated} datasets of request {counter} have no created_on date and were skipped",
+                               extra={"fields": {"request": counter, "skipped": undated}})
+            if watermarks is not None:
+                advance_watermark(watermarks[k], walked, reached_mark)
+            counter+=1
 
-                # if there exists a next, then do the following
-                if n:
-                    os.system(f"curl \"{next_curl}\" -o {file}")
-                    d, n, next_curl = import_json(file)
-                    #d = dict(os.popen(f"curl \"{next_curl}\""))
-                    #print(f"This is d:{d}")
 
-                else:
-                    break
+    return good_ids
+
+
+def read_harvested_ids(file:str):
+    '''
+    :param file: existing metadata file
+    :return: sets with the metagenome ids and project ids of all datasets in the file
+    '''
+    metagenome_ids = set()
+    project_ids = set()
+    with open_file(file, newline='') as csvfile:
+        rows = csv.reader(csvfile, delimiter=',')
+        next(rows, None)  # header
+        for row in rows:
+            if len(row) > 2:
+                metagenome_ids.add(row[0])
+                project_ids.add(row[2])
+
+    return metagenome_ids, project_ids
+
+
+def advance_watermark(mark:dict, walked:list, reached_mark:bool):
+    '''
+    High-water mark of an incremental request: {"created_on": newest created_on, "ids": metagenome ids already seen}.
+    Datasets older than created_on are never requested again, datasets in ids are skipped.
+    :param mark: high-water mark of the request, updated in place
+    :param walked: (metagenome id, created_on) of all datasets newer than the mark seen in this run, newest first
+    :param reached_mark: False, if the run stopped at the limit before it reached the old mark. The mark can then not
+    be moved, because the datasets in between have not been seen yet. Instead, all ids seen are remembered.
+    '''
+    if not walked:
+        return
+
+    if reached_mark:
+        newest = max(created_on for mgm, created_on in walked)
+        ids = set(mgm for mgm, created_on in walked if created_on == newest)
+        if newest == mark["created_on"]:
+            ids |= set(mark["ids"])
+        mark["created_on"] = newest
+        mark["ids"] = sorted(ids)
+    else:
+        mark["ids"] = sorted(set(mark["ids"]) | set(mgm for mgm, created_on in walked))
+
+
+def load_watermarks(state_file:str, all_curls:dict):
+    '''
+    :param state_file: json file containing the high-water marks of previous incremental runs
+    :param all_curls: dict containing all curls. The marks are stored under the fingerprint of the request.
+    :return: list with one high-water mark per request (see advance_watermark)
+    '''
+    state = {}
+    if os.path.exists(state_file):
+        with open(state_file) as f:
+            state = js.load(f)
+
+    return [state.get(search_fingerprint(all_curls[key]), {"created_on": None, "ids": []}) for key in all_curls.keys()]
+
+
+def save_watermarks(state_file:str, all_curls:dict, watermarks:list):
+
+    state = {}
+    if os.path.exists(state_file):
+        with open(state_file) as f:
+            state = js.load(f)
+
+    for mark, key in zip(watermarks, all_curls.keys()):
+        state[search_fingerprint(all_curls[key])] = mark
+
+    with open(f"{state_file}.{os.getpid()}", 'w') as f:
+        js.dump(state, f, indent=1)
+    os.replace(f"{state_file}.{os.getpid()}", state_file)
+
+
+def shard_of(project_n:str, shard_count:int):
+    '''
+    Datasets are partitioned by project, so that both duplicate rules (metagenome and --no_duplicate_proj) can be
+    decided within a single shard.
+    :return: index of the shard the project belongs to (crc32 of the project id mod shard_count)
+    '''
+    return zlib.crc32(str(project_n).encode()) % shard_count
+
+
+def shard_name(name:str, shard:tuple):
+    '''
+    :param name: file name, e.g. request_0.json
+    :param shard: (shard index, shard count)
+    :return: file name of the shard, e.g. request_0.shard0of4.json
+    '''
+    root, ext = os.path.splitext(name)
+    return f"{root}.shard{shard[0]}of{shard[1]}{ext}"
+
+
+def create_metadata_shard(file_list:list, output:str, threshold:float, limits:list, min_species:int, metadata:dict,
+                          p:bool, ignore_slope:bool, min_reads:int, no_dup_proj:bool, shard:tuple,
+                          cache:dict=None, rc_store:dict=None, compression:str=None, progress:Progress=None):
+    '''
+    Worker of a sharded harvest. Walks the same API Search as create_metadata, but only evaluates the datasets of its
+    own shard (see shard_of). Every evaluated dataset is written to the shard file together with the number of its
+    request, its position in the search results and whether it was accepted, so that merge_shards can replay the
+    selection of a single-node run.
+    A request is finished once the shard holds as many accepted datasets as the limit, counted with the duplicate rules
+    applied within the shard. The shard has seen at least the datasets a single-node run would have seen, so those
+    datasets are accepted in the single-node run as well and the merged result is identical.
+    :param shard: (shard index, shard count)
+    :param compression: "gzip" or "zstd" to compress the shard file. Optional.
+    :param progress: Progress that counts the evaluated datasets. Optional.
+    :return: shard file <output>.shard<i>of<n>.csv and a list with the accepted metagenomic ids of this shard
+    '''
+    index, shard_count = shard
+    with open_file(with_compression(f'{shard_name(output, shard)}.csv', compression), 'w', newline='') as csvfile:
+        csvfile_writer = csv.writer(csvfile, delimiter=',')
+        csvfile_writer.writerow(['query', 'position', 'accepted'] + METADATA_COLUMNS)
+        counter = 1
+        evaluated = {}  # the same metagenome can be found by several requests, but is only fetched once
+        metagenome_ids = set()
+        good_ids = []
+        project_ids = set()
+        for k, file in enumerate(file_list):
+
+            if progress is not None:
+                progress.begin(counter, limits[k])
+            logger.info(f"Processing {file}", extra={"fields": {"request": counter, "file": file, "shard": index}})
+            temp_ids = []
+            for position, row in enumerate(iterate_candidates(file, cache)):
+                if not p and is_16s(row):
+                    continue
+                mgm, project_n = row[0], row[2]
+                if shard_of(project_n, shard_count) != index:
+                    continue
+
+                if mgm not in evaluated:
+                    evaluated[mgm] = evaluate_candidate(row, metadata[counter], threshold, min_species, min_reads,
+                                                        ignore_slope, rc_store)
+                r_co, grad, species_count = evaluated[mgm]
+                if progress is not None:
+                    progress.update(r_co)
+                csvfile_writer.writerow([counter, position, int(bool(r_co))] + row +
+                                        [species_count, grad, metadata[counter]])
+
+                if claim_candidate(mgm, project_n, metagenome_ids, project_ids, no_dup_proj) and r_co:
+                    temp_ids.append(mgm)
+                    good_ids.append(mgm)
+                    if len(temp_ids) == limits[k]:
+                        break
 
             counter+=1
 
+    return good_ids
+
+
+def read_shard(file:str):
+
+    with open_file(file, newline='') as shard_file:
+        rows = csv.reader(shard_file, delimiter=',')
+        next(rows)  # header
+        for row in rows:
+            yield int(row[0]), int(row[1]), row[2] == '1', row[3:]
+
+
+def merge_shards(output:str, shard_count:int, limits:list, no_dup_proj:bool, compression:str=None):
+    '''
+    Merges the shard files of a sharded harvest into one metadata file. The shards are read in the order of the
+    search results and the selection of create_metadata (duplicate rules and limit per request) is replayed, so the
+    result is the same as the one of a single-node run. No requests are sent to MG-Rast.
+    :param shard_count: number of shards
+    :param compression: compression of the shard files and the output file. Optional.
+    :return: a file with metagenome information and a list with all unique metagenomic ids
+    '''
+    shards = [read_shard(with_compression(f'{shard_name(output, (i, shard_count))}.csv', compression))
+              for i in range(shard_count)]
+
+    with open_file(with_compression(f'{output}.csv', compression), 'w', newline='') as csvfile:
+        csvfile_writer = csv.writer(csvfile, delimiter=',')
+        csvfile_writer.writerow(METADATA_COLUMNS)
+        metagenome_ids = set()
+        good_ids = []
+        project_ids = set()
+        accepted_count = {}
+        for query, position, accepted, row in heapq.merge(*shards, key=lambda record: record[:2]):
+            if accepted_count.get(query, 0) == limits[query-1]:    # request already finished
+                continue
+            if not claim_candidate(row[0], row[2], metagenome_ids, project_ids, no_dup_proj):
+                continue
+
+            if accepted:
+                accepted_count[query] = accepted_count.get(query, 0) + 1
+                good_ids.append(row[0])
+                csvfile_writer.writerow(row)
 
     return good_ids
 
 
+def plan_harvest(all_curls:dict, json:list, limits:list, threshold:float, min_species:int, min_reads:int,
+                 ignore_slope:bool, samples:int, workers:int, cache:dict=None):
+    '''
+    Dry run of a harvest. Only the first page of each API Search is requested and a few rarefaction curves of it are
+    checked to estimate the acceptance rate. From this, the number of search pages and rarefaction requests, the data
+    volume and the wall time of the harvest are predicted. Duplicates between the requests are not taken into account.
+    :param all_curls: dict containing all curls
+    :param json: names of the json files
+    :param samples: number of rarefaction curves that are checked per request
+    :param workers: number of shard workers. Each worker walks all search pages, but the rarefaction requests are
+    shared between them.
+    :param cache: dict with the search cache settings. None disables the cache.
+    :return: list with one dict of predictions per request
+    '''
+    plans = []
+    for k, key in enumerate(all_curls.keys()):
+        page_start = time.time()
+        cached = fetch_search_page(all_curls[key], json[key-1], cache)
+        page_time = time.time() - page_start
+
+        # one streaming pass: count the datasets and keep only the samples
+        page = {}
+        stats = {}
+        usable_count = 0
+        sampled = []
+        for row in stream_search_page(json[key-1], page, stats=stats):
+            usable_count += 1
+            if len(sampled) < samples:
+                sampled.append(row)
+        page_size = max(stats["datasets"], 1)
+        total = int(page.get('total_count', page_size))
+        usable_rate = usable_count / page_size    # datasets that pass the 16S and completeness filters
+
+        accepted = 0
+        curve_bytes = 0
+        curve_time = 0
+        for row in sampled:
+            curve_start = time.time()
+            rarefactions = fetch_rarefaction_text(row[0])
+            curve_time += time.time() - curve_start
+            curve_bytes += len(rarefactions)
+            try:
+                r_co, grad, species_count = check_rarefaction(ast.literal_eval(rarefactions), threshold, min_species,
+                                                              min_reads, ignore_slope)
+            except (ValueError, SyntaxError):
+                r_co = False
+            accepted += bool(r_co)
+
+        usable = int(total * usable_rate)
+        acceptance = accepted / len(sampled) if sampled else 0
+        # without any accepted sample, the whole search has to be walked
+        candidates = min(usable, math.ceil(limits[k] / acceptance)) if acceptance > 0 else usable
+        pages = max(math.ceil(candidates / max(page_size * usable_rate, 1)), 1)
+        curve_time = curve_time / len(sampled) if sampled else 0
+        curve_bytes = curve_bytes / len(sampled) if sampled else 0
+        if cached:  # the time of a cached page says nothing about MG-Rast
+            page_time = curve_time
+
+        plans.append({"request": key, "total": total, "acceptance": acceptance, "sampled": len(sampled),
+                      "pages": pages, "rarefactions": candidates,
+                      "bytes": pages * stats["characters"] + candidates * curve_bytes,
+                      "seconds": pages * page_time + candidates * curve_time / workers})
+
+    print(f"{bcolors.HEADER}{'request':>8} {'results':>9} {'accepted':>12} {'pages':>7} {'curves':>8} "
+          f"{'volume':>10} {'time':>10}{bcolors.ENDC}")
+    for plan in plans + [{"request": "total", "total": sum(p["total"] for p in plans), "acceptance": None,
+                          "pages": sum(p["pages"] for p in plans), "rarefactions": sum(p["rarefactions"] for p in plans),
+                          "bytes": sum(p["bytes"] for p in plans), "seconds": sum(p["seconds"] for p in plans)}]:
+        acceptance = "" if plan["acceptance"] is None else f"{plan['acceptance']:.0%} of {plan['sampled']}"
+        print(f"{plan['request']:>8} {plan['total']:>9} {acceptance:>12} {plan['pages']:>7} {plan['rarefactions']:>8} "
+              f"{plan['bytes'] / 1e6:>8.1f}MB {plan['seconds'] / 60:>8.1f}min")
+    print(f"Predicted for {workers} worker(s).")
+
+    return plans
+
+
+def repair_rc_store(path:str):
+    '''
+    Brings the files of a rarefaction curve store back in line after an interrupted run. Each file is buffered
+    separately, so x.f64, y.f64, offsets.i64 and rows.csv can end after a different number of curves. All files are
+    truncated to the curves that are complete in every file.
+    :param path: directory of the store
+    :return: end offset of the last complete curve in x.f64 / y.f64 (None if rows.csv has no header yet)
+    '''
+    files = {f: os.path.join(path, f) for f in ("x.f64", "y.f64", "offsets.i64", "rows.csv")}
+    for file in files.values():
+        open(file, 'ab').close()
+
+    # byte position after the header and after each complete row of rows.csv
+    row_ends = []
+    consumed = 0
+    with open(files["rows.csv"], 'rb') as rows_file:
+        def lines():
+            nonlocal consumed
+            for line in rows_file:
+                consumed += len(line)
+                yield line.decode('utf-8', errors='replace')
+        try:
+            for _ in csv.reader(lines(), delimiter=','):
+                row_ends.append(consumed)
+        except csv.Error:   # the last row ends inside a quoted field
+            pass
+        rows_file.seek(0, os.SEEK_END)
+        if rows_file.tell() > 0 and row_ends and row_ends[-1] == rows_file.tell():
+            rows_file.seek(-1, os.SEEK_END)
+            if rows_file.read(1) != b'\n':   # the last row was cut off
+                row_ends.pop()
+    if not row_ends:
+        for file in files.values():
+            os.truncate(file, 0)
+        return None
+
+    offsets = np.fromfile(files["offsets.i64"], dtype='<i8')
+    values = min(os.path.getsize(files["x.f64"]), os.path.getsize(files["y.f64"])) // 8
+    n = min(len(offsets), len(row_ends)-1)
+    while n > 0 and offsets[n-1] > values:
+        n -= 1
+    end = int(offsets[n-1]) if n > 0 else 0
+
+    if n < len(offsets) or n < len(row_ends)-1 or os.path.getsize(files["x.f64"]) != end*8 \
+            or os.path.getsize(files["y.f64"]) != end*8:
+        logger.warning(f"{bcolors.WARNING}Rarefaction curve store {path} was not closed properly. "
+                       f"It is truncated to its {n} complete curves{bcolors.ENDC}",
+                       extra={"fields": {"rc_store": path, "curves": n}})
+    os.truncate(files["offsets.i64"], n*8)
+    os.truncate(files["x.f64"], end*8)
+    os.truncate(files["y.f64"], end*8)
+    os.truncate(files["rows.csv"], row_ends[n])
+
+    return end
+
+
+def open_rc_store(path:str):
+    '''
+    Opens (or creates) a rarefaction curve store for appending. The store is a directory containing
+    x.f64 / y.f64: the x and y values of all curves as flat little-endian float64 arrays,
+    offsets.i64: the end offset of each curve in x.f64 / y.f64 (little-endian int64),
+    rows.csv: the metadata of each curve (one line per curve, same order as offsets.i64).
+    Curves left incomplete by an interrupted run are removed first (see repair_rc_store).
+    :param path: directory of the store
+    :return: dict with the open file handles of the store
+    '''
+    os.makedirs(path, exist_ok=True)
+    end = repair_rc_store(path)
+
+    store = {"x": open(os.path.join(path, "x.f64"), 'ab'),
+             "y": open(os.path.join(path, "y.f64"), 'ab'),
+             "offsets": open(os.path.join(path, "offsets.i64"), 'ab'),
+             "rows": open(os.path.join(path, "rows.csv"), 'a', newline='')}
+    store["writer"] = csv.writer(store["rows"], delimiter=',')
+    store["end"] = end or 0
+    if end is None:
+        store["writer"].writerow(METADATA_COLUMNS[:12] + [METADATA_COLUMNS[-1]])
+
+    return store
+
+
+def append_rc_curve(store:dict, row:list, keyword:list, rarefactions:list):
+    '''
+    :param store: rarefaction curve store opened with open_rc_store
+    :param row: the twelve metadata columns of the dataset
+    :param keyword: metadata of the API Search the dataset was found with
+    :param rarefactions: rarefaction curve as returned by MG-Rast ([[x1, y1], [x2, y2], ...])
+    '''
+    try:
+        r = np.array(rarefactions, dtype='<f8')
+        x, y = r[:,0], r[:,1]
+    except (ValueError, TypeError, IndexError):  # malformed curves are stored empty and never accepted
+        x = y = np.empty(0, dtype='<f8')
+
+    store["x"].write(np.ascontiguousarray(x).tobytes())
+    store["y"].write(np.ascontiguousarray(y).tobytes())
+    store["end"] += len(x)
+    store["offsets"].write(np.array([store["end"]], dtype='<i8').tobytes())
+    store["writer"].writerow(list(row[:12]) + [keyword])
+
+
+def close_rc_store(store:dict):
+
+    for f in ("x", "y", "offsets", "rows"):
+        store[f].close()
+
+
+def load_rc_store(path:str):
+    '''
+    Memory-maps a rarefaction curve store, so that only the values that are actually accessed are read from disk.
+    :param path: directory of the store
+    :return: x values, y values and end offsets of all curves
+    '''
+    arrays = []
+    for name, dtype in (("x.f64", '<f8'), ("y.f64", '<f8'), ("offsets.i64", '<i8')):
+        file = os.path.join(path, name)
+        if os.path.getsize(file) == 0:  # empty files cannot be memory-mapped
+            arrays.append(np.empty(0, dtype=dtype))
+        else:
+            arrays.append(np.memmap(file, dtype=dtype, mode='r'))
+
+    return arrays[0], arrays[1], arrays[2]
+
+
 def check_rarefaction(r:list, threshold:float, min_species:int, min_reads:int, ignore_slope:bool):
     '''
     #print(f"This is the rarefactions number {rarefactions}")
@@ -363,7 +1212,6 @@ def check_rarefaction(r:list, threshold:float, min_species:int, min_reads:int, i
         if y2 < y1:
             y2 = y[-2]
             y1 = y[-4]
-        print(min_species)
         slope = y2 - y1
         if y2 < min_species:
             return False, slope, y2
@@ -447,25 +1295,94 @@ def main():
     no_dup_proj = args["no_duplicate_proj"]
     json = json_name_converter(args["json"], list(metadata.keys()))
     threshold = args["rarefaction_threshold"]
-    print(limit)
-    print(metadata)
-    print(min_species_count)
+    setup_logging(args["log_level"], args["quiet"], args["log_json"])
+    logger.debug(f"limits: {limit}, metadata: {metadata}, min species count: {min_species_count}")
     limits = limit_config(limit, metadata)
+    output, compression = split_compression(output, args["compress"])
+    output_file = with_compression(f"{output}.csv", compression)
+    json = [with_compression(name, compression) for name in json]
+    shard = args["shard"]
+    incremental = args["incremental"]
+
+    if incremental:
+        if ordered_by != "created_on" or shard is not None or args["merge_shards"]:
+            logger.error(f"{bcolors.FAIL}--incremental requires --order_field created_on and cannot be combined "
+                         f"with sharding.{bcolors.ENDC}")
+            sys.exit(1)
+        desc = True # newest datasets first, so the search can stop at the high-water mark
+
+    if args["merge_shards"]:
+        # combine the results of all shard workers, no requests necessary
+        metagenomic_ids = merge_shards(output, args["merge_shards"], limits, no_dup_proj, compression)
+        logger.info(f"{bcolors.OKGREEN}{args['merge_shards']} shards merged. File saved to {output_file}"
+                    f"{bcolors.ENDC}", extra={"fields": {"shards": args["merge_shards"], "file": output_file,
+                                                        "accepted": len(metagenomic_ids)}})
+        stop = time.time()
+        logger.info(f"Overall Time: {round(stop-start,2)}s", extra={"fields": {"seconds": round(stop-start,2)}})
+        return
+
+    cache = None
+    if not args["no_cache"]:
+        cache = {"dir": args["cache_dir"], "ttl": args["cache_ttl"], "max_entries": args["cache_max_entries"],
+                 "compression": compression}
+        os.makedirs(cache["dir"], exist_ok=True)
+        cache["entries"] = sum(1 for f in os.listdir(cache["dir"]) if f.endswith(".info"))
+        if incremental: # new datasets shift all pages of a descending search, so always revalidate
+            cache["ttl"] = 0
+
+    if args["plan"]:
+        all_curls = generate_all_curls(metadata,limits,desc,spd,ordered_by)
+        workers = args["plan_workers"] or (shard[1] if shard is not None else 1)
+        plan_harvest(all_curls, json, limits, threshold, min_species_count, min_reads, ignore_slope,
+                     args["plan_samples"], workers, cache)
+        stop = time.time()
+        logger.info(f"Overall Time: {round(stop-start,2)}s", extra={"fields": {"seconds": round(stop-start,2)}})
+        return
+
+    rc_store = None
+    if args["rc_store"]:
+        rc_store_path = args["rc_store"].rstrip("/")
+        if shard is not None:   # workers on the same host must not append to the same store
+            rc_store_path = shard_name(rc_store_path, shard)
+        rc_store = open_rc_store(rc_store_path)
+
+    if shard is not None:   # workers on the same host must not share their search pages
+        json = [shard_name(name, shard) for name in json]
 
     # generate all curls
     all_curls = generate_all_curls(metadata,limits,desc,spd,ordered_by)
 
-    # run all curls and save the results to the desired json files
-    all_files = run_curls(all_curls, json)
-    print(limits)
-    # create file with metagenmic information and returna list with all metagenomic ids
-    metagenomic_ids = create_metadata(all_files, output, threshold, limits, min_species_count, metadata, phylogeny,
-                                      ignore_slope, min_reads, no_dup_proj)
-
+    watermarks = None
+    if incremental:
+        watermarks = load_watermarks(incremental, all_curls)
 
+    try:
+        # run all curls and save the results to the desired json files
+        all_files = run_curls(all_curls, json, cache)
+        logger.debug(f"limits per request: {limits}")
+        # create file with metagenmic information and returna list with all metagenomic ids
+        progress = Progress(args["progress_interval"]).start()
+        try:
+            if shard is not None:
+                metagenomic_ids = create_metadata_shard(all_files, output, threshold, limits, min_species_count,
+                                                        metadata, phylogeny, ignore_slope, min_reads, no_dup_proj,
+                                                        shard, cache, rc_store, compression, progress)
+            else:
+                metagenomic_ids = create_metadata(all_files, output, threshold, limits, min_species_count, metadata,
+                                                  phylogeny, ignore_slope, min_reads, no_dup_proj, cache, rc_store,
+                                                  watermarks, compression, progress)
+        finally:
+            progress.stop()
+        logger.info(f"{bcolors.OKGREEN}{len(metagenomic_ids)} datasets accepted{bcolors.ENDC}",
+                    extra={"fields": {"accepted": len(metagenomic_ids)}})
+        if incremental:
+            save_watermarks(incremental, all_curls, watermarks)
+    finally:
+        if rc_store is not None:
+            close_rc_store(rc_store)
 
     stop = time.time()
-    print(f"Overall Time: {round(stop-start,2)}s")
+    logger.info(f"Overall Time: {round(stop-start,2)}s", extra={"fields": {"seconds": round(stop-start,2)}})
 
 if __name__ == '__main__':
     main()
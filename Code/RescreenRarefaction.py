@@ -0,0 +1,141 @@
+import csv
+import os
+import time
+import argparse as ap
+import numpy as np
+from GenerateMetadataFile import METADATA_COLUMNS, bcolors, load_rc_store
+from CompressedIO import open_file, split_compression, with_compression
+
+
+def command_line():
+    parser = ap.ArgumentParser("Metagenomic Data Collection (via MG-Rast) - Re-screen stored rarefaction curves")
+
+    # adapted from stackoverflow.com
+    def check_positive(value):
+        ivalue = int(value)
+        if ivalue < 0:
+            raise ap.ArgumentTypeError("%s is an invalid positive int value" % value)
+        return ivalue
+
+    parser.add_argument("-i", "--input", help="Rarefaction curve store(s) that were created with the --rc_store option "
+                                              "of GenerateMetadataFile.py. Several stores, e.g. of all shards of a "
+                                              "harvest, are screened as one.",
+                        nargs='+', required=True)
+    parser.add_argument("-o", "--output", help="Name of the Output csv file. Default: metadata", default="metadata")
+    parser.add_argument("-r", "--rarefaction_threshold", help="Assign a threshold for the rarefaction curve. "
+                                                              "Note: The smaller the threshold, the better the"
+                                                              " sequencing depth.",
+                        default=0.5, type=float)
+    parser.add_argument("--min_species_count", help="Set a minimum number of species count. Any dataset with less "
+                                                    " species count will be discarded. ",
+                        default=1000, type=check_positive)
+    parser.add_argument("--set_min_readNumber", help="Set a minimum number of reads that each dataset shall consist of."
+                        , default=1000000, type=check_positive)
+    parser.add_argument("--ignore_rc", help="If this option is selected, the slope of the rarefaction curve will not "
+                                            "be considered anymore in the acceptance process for a dataset.",
+                        action='store_true')
+    parser.add_argument("--compress", help="Compress the output file with gzip (.gz) or zstd (.zst).",
+                        default=None, choices=["gzip", "zstd"])
+
+    return vars(parser.parse_args())
+
+
+def screen_curves(x:np.ndarray, y:np.ndarray, ends:np.ndarray, threshold:float, min_species:int, min_reads:int,
+                  ignore_slope:bool):
+    '''
+    Vectorized version of check_rarefaction (GenerateMetadataFile.py) for all curves of a store at once.
+    Only the last four points of each curve are read.
+    :param x: x values of all curves
+    :param y: y values of all curves
+    :param ends: end offset of each curve in x and y
+    :return: three arrays: accepted (bool), slope and species count of each curve
+    '''
+    ends = np.asarray(ends, dtype=np.int64)
+    starts = np.concatenate(([0], ends[:-1]))
+    lengths = ends - starts
+
+    accepted = np.zeros(len(ends), dtype=bool)
+    slope = np.zeros(len(ends))
+    species = np.zeros(len(ends))
+    if len(y) == 0:
+        return accepted, slope, species
+
+    # curves with less than 3 points are rejected (check_rarefaction fails on them)
+    valid = lengths >= 3
+    last = np.where(valid, ends-1, 0)
+    y2 = y[last]
+    y1 = y[np.where(valid, ends-3, 0)]
+    max_numb_read = x[last]
+
+    # if the curve drops at the end, the previous points are used. This needs at least 4 points
+    dropped = valid & (y2 < y1)
+    valid &= ~dropped | (lengths >= 4)
+    shifted = dropped & valid
+    y2 = np.where(shifted, y[np.where(shifted, ends-2, 0)], y2)
+    y1 = np.where(shifted, y[np.where(shifted, ends-4, 0)], y1)
+
+    slope = np.where(valid, y2 - y1, 0)
+    species = np.where(valid, y2, 0)
+    accepted = valid & ~(y2 < min_species) & ~(max_numb_read < min_reads)
+    if not ignore_slope:
+        accepted &= slope < threshold
+
+    return accepted, slope, species
+
+
+def rescreen(stores:list, output:str, threshold:float, min_species:int, min_reads:int, ignore_slope:bool,
+             compression:str=None):
+    '''
+    Applies new thresholds to all curves of one or more rarefaction curve stores and writes the accepted datasets to
+    a new metadata file. The stores are read in the given order, as if they were one store. Each metagenome is only
+    written once.
+    :param stores: directories of the rarefaction curve stores, e.g. the stores of all shards of a harvest
+    :param output: name of the output csv file (without extension)
+    :param compression: "gzip" or "zstd" to compress the output file. Optional.
+    :return: number of curves in the stores and number of accepted datasets
+    '''
+    screened = []
+    for store in stores:
+        x, y, ends = load_rc_store(store)
+        with open(os.path.join(store, "rows.csv"), newline='') as rows_file:
+            count = sum(1 for row in csv.reader(rows_file, delimiter=',') if len(row) == 13) - 1  # without header
+        if count != len(ends):
+            raise ValueError(f"{store} is inconsistent: rows.csv has {count} rows, but offsets.i64 has {len(ends)} "
+                             f"curves. Open it once with GenerateMetadataFile.py --rc_store to repair it.")
+        # each store is screened on its own, so its curves never have to be copied out of the memory map
+        screened.append(screen_curves(x, y, ends, threshold, min_species, min_reads, ignore_slope))
+
+    metagenome_ids = set()
+    with open_file(with_compression(f'{output}.csv', compression), 'w', newline='') as csvfile:
+        csvfile_writer = csv.writer(csvfile, delimiter=',')
+        csvfile_writer.writerow(METADATA_COLUMNS)
+
+        for store, (accepted, slope, species) in zip(stores, screened):
+            with open(os.path.join(store, "rows.csv"), newline='') as rows_file:
+                rows = csv.reader(rows_file, delimiter=',')
+                next(rows)  # header
+
+                for i, row in enumerate(rows):
+                    if not accepted[i] or row[0] in metagenome_ids:
+                        continue
+                    metagenome_ids.add(row[0])
+                    csvfile_writer.writerow(row[:12] + [species[i], slope[i], row[12]])
+
+    return sum(len(accepted) for accepted, _, _ in screened), len(metagenome_ids)
+
+
+def main():
+
+    start = time.time()
+    args = command_line()
+    output, compression = split_compression(args["output"], args["compress"])
+    curves, good = rescreen(args["input"], output, args["rarefaction_threshold"], args["min_species_count"],
+                            args["set_min_readNumber"], args["ignore_rc"], compression)
+    print(f"{bcolors.OKGREEN}{good} of {curves} curves accepted. "
+          f"File saved to {with_compression(output + '.csv', compression)}{bcolors.ENDC}")
+
+    stop = time.time()
+    print(f"Overall Time: {round(stop-start,2)}s")
+
+if __name__ == '__main__':
+    main()